@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
 # Copyright (c) 2016 by MemSQL. All rights reserved.
@@ -17,7 +17,7 @@
 #
 
 import argparse
-import blessed
+import atexit
 import collections
 import csv
 import jinja2
@@ -26,19 +26,16 @@ import os
 import re
 import subprocess
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import NamedTemporaryFile
 
-from dbbench import RunDbbench, DatabaseSpec, QueryStatistic, EnsureDbbenchInPath, CleanQuery
+from dbbench import DbbenchSession, DatabaseSpec, EnsureDbbenchInPath, CleanQuery, ElapsedMillisArray
 
 import abstats
 
 logger = logging.getLogger(__name__)
 
-# Ensure that we can output color escape characters and utf-8.
-reload(sys)
-sys.setdefaultencoding("utf-8")
-
-term = blessed.Terminal()
 _CONFIG_TEMPLATE = jinja2.Template(u"""
 [setup]
 {% if setupQueries %}
@@ -46,50 +43,101 @@ _CONFIG_TEMPLATE = jinja2.Template(u"""
 query={{ sq }}
 {% endfor %}
 {% endif %}
+{% for _, queryFile in jobs %}
 {% for _ in range(warmupIterations) %}
 query-file={{ queryFile }}
 {% endfor %}
+{% endfor %}
 
-[job "q"]
+{% for name, queryFile in jobs %}
+[job "{{ name }}"]
 query-file={{ queryFile }}
 count={{ iterations }}
+{% endfor %}
 """, trim_blocks=True)
 
 
-def MakeDbbenchConfig(args, queryFile, setupQueries=None):
+_tempFilePool = threading.local()
+
+
+def _DiscardTempFile(tempFile):
+    tempFile.close()
+    #
+    # As elsewhere, preserve the temporary files if we logged the
+    # commands that referenced them.
+    #
+    if logger.getEffectiveLevel() > logging.DEBUG:
+        try:
+            os.unlink(tempFile.name)
+        except OSError:
+            pass
+
+
+def _GetPooledTempFile(index, suffix):
+    """
+    Returns a reusable per-thread temp file, truncated and rewound.
+
+    Recreating temp files for every RunQueries call pays a
+    mkstemp+unlink round trip through the filesystem metadata path per
+    file; instead keep each thread's files for the life of the process
+    and reuse them, cleaning up at exit.
+    """
+    files = getattr(_tempFilePool, 'files', None)
+    if files is None:
+        files = _tempFilePool.files = {}
+    key = (index, suffix)
+    tempFile = files.get(key)
+    if tempFile is None:
+        tempFile = NamedTemporaryFile(mode="w", suffix=suffix, delete=False)
+        files[key] = tempFile
+        atexit.register(_DiscardTempFile, tempFile)
+    else:
+        tempFile.seek(0)
+        tempFile.truncate()
+    return tempFile
+
+
+def MakeDbbenchConfig(args, jobs, setupQueries=None):
     """
-    Generates a dbbench config to test the given query.
+    Generates a dbbench config to test the given jobs.
 
     Arguments:
         args: A python namespace object containing warmpup_iterations and
             iterations.
-        queryFile: A file containg a single query to test
+        jobs: A list of (job name, query file) tuples, one per query to
+            test.
         setupQuery: An optional query to run during setup. This is run once
             and can set a session variable.
 
     Returns:
         A valid dbbench config as a string.
     """
-    return _CONFIG_TEMPLATE.render(queryFile=queryFile,
+    return _CONFIG_TEMPLATE.render(jobs=jobs,
                                    warmupIterations=args.warmup_iterations,
                                    iterations=args.iterations,
                                    setupQueries=setupQueries)
 
 
-def RunQuery(args, dbspec, query, setupQueries=None):
+def RunQueries(args, session, jobs, setupQueries=None):
     """
-    Runs dbbench for the given config and returns an array of query statistics.
+    Runs dbbench once for all jobs and returns their query statistics.
+
+    Summary:
+        Writes one config containing a [job] section per query and invokes
+        dbbench a single time, amortizing the subprocess spawn and database
+        connection setup across the whole suite instead of paying them for
+        every query.
 
     Arguments:
         args: The command line arguments containing a `verbostity` level.
-        dbspec: A DatabaseSpec object containing the database connection
-            information.
-        query: The query to run.
+        session: A DbbenchSession for the database to test.
+        jobs: An ordered mapping of job name to the query to run.
         setupQueries: An optional list of query to run during setup. They are
            run once and can set a session variable.
 
     Returns:
-        A list of QueryStatistic tuples for the queries run by dbbench.
+        A dict mapping each job name to the statistics record array for
+        that job.
 
     Raises:
         subprocess.CalledProcessError: if `dbbench` returned a non-zero exit
@@ -99,47 +147,61 @@ def RunQuery(args, dbspec, query, setupQueries=None):
     """
 
     #
-    # Write the query to a temp file so we do not have to worry about ini
-    # escaping issues.
-    #
-    # If we will be logging the command executed, make sure to preserve the
-    # temporary files.
+    # Write each query to a (pooled) temp file so we do not have to worry
+    # about ini escaping issues.
     #
-    keepTemporaryFiles = logger.getEffectiveLevel() <= logging.DEBUG
-    with NamedTemporaryFile(delete=not keepTemporaryFiles,
-                            suffix=".sql") as queryFile:
+    jobFiles = []
+    for (i, (name, query)) in enumerate(jobs.items()):
+        queryFile = _GetPooledTempFile(i, ".sql")
         queryFile.write(query)
         queryFile.flush()
+        jobFiles.append((name, queryFile.name))
+
+    configFile = _GetPooledTempFile(0, ".ini")
+    configFile.write(MakeDbbenchConfig(args, jobFiles,
+                                       setupQueries=setupQueries))
+    configFile.flush()
+
+    statistics = session.Run(configFile.name)
 
-        with NamedTemporaryFile(delete=not keepTemporaryFiles,
-                                suffix=".ini") as configFile:
-            configFile.write(MakeDbbenchConfig(args, queryFile.name,
-                                               setupQueries=setupQueries))
-            configFile.flush()
+    return dict((name, statistics[statistics.name == name])
+                for name in jobs)
 
-            return RunDbbench(dbspec, configFile.name)
 
-def DoQuery(args, A_dbspec, B_dbspec, query):
+def IterQueries(queryFile, chunkSize=65536):
+    """
+    Yields the cleaned statements from a SQL file one at a time.
+
+    Reads the file a chunk at a time rather than loading it whole, so
+    peak memory is bounded by the largest single statement instead of
+    the file size.
+    """
+    buffered = ""
+    while True:
+        chunk = queryFile.read(chunkSize)
+        if not chunk:
+            break
+        buffered += chunk
+        statements = buffered.split(";")
+        buffered = statements.pop()
+        for statement in statements:
+            query = CleanQuery(statement)
+            if query:
+                yield query
+    query = CleanQuery(buffered)
+    if query:
+        yield query
+
+
+def DoQuery(args, query, aStats, bStats):
     logger.info("testing query " + repr(query))
-    queryPassed = True
 
-    try:
-        logger.debug("testing %s", args.A_name)
-        aStats = RunQuery(args, A_dbspec, query,
-                            setupQueries=args.A_setup_query)
-        logger.debug("testing %s", args.B_name)
-        bStats = RunQuery(args, B_dbspec, query,
-                            setupQueries=args.B_setup_query)
-    except subprocess.CalledProcessError as e:
-        logger.error("Failed to execute dbbench with query %s: %s" %
-                      (repr(query), e.output))
-        if args.fatal_dbbench_errors:
-            sys.exit("Exiting immediately due to --fatal-dbbench-errors")
-        else:
-            return False
-
-    aExecutions = [float(s.elapsedMicros) / 1000.0 for s in aStats]
-    bExecutions = [float(s.elapsedMicros) / 1000.0 for s in bStats]
+    if not len(aStats) or not len(bStats):
+        logger.error("No statistics recorded for query %s", repr(query))
+        return False
+
+    aExecutions = ElapsedMillisArray(aStats)
+    bExecutions = ElapsedMillisArray(bStats)
 
     return abstats.DoTest(args, args.B_name, bExecutions,
                           args.A_name, aExecutions, unit="ms")
@@ -149,7 +211,7 @@ def main():
     parser = argparse.ArgumentParser(
         description="Test query execution performance (old vs new codegen).",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument("-v", "--verbosity", action="count",
+    parser.add_argument("-v", "--verbosity", action="count", default=0,
                         help="Increase output verbosity")
 
     def _add_config_to_group(group, name):
@@ -188,16 +250,12 @@ def main():
     qg.add_argument("--query-file", type=argparse.FileType("r"),
                     help="SQL query file containing multiple queries to test.")
 
-    dg = parser.add_mutually_exclusive_group()
-    dg.add_argument("--fatal-dbbench-errors", dest="fatal_dbbench_errors",
-                    action="store_true",
-                    help="Stop immediately if dbbench exits non zero")
-    dg.add_argument("--no-fatal-dbbench-errors", dest="fatal_dbbench_errors",
-                    action="store_false")
-    parser.set_defaults(fatal_dbbench_errors=True)
-
     abstats.AddStatsOptions(parser)
 
+    parser.add_argument("--cache-identical-queries", action="store_true",
+                        help="Measure duplicate queries only once and reuse "
+                        "the result. Off by default since benchmark "
+                        "results are noisy.")
     parser.add_argument("--iterations", type=int, default=30,
                         help="Number of iterations to perform for each test.")
     parser.add_argument("--warmup-iterations", type=int, default=5,
@@ -225,13 +283,49 @@ def main():
     if args.query is not None:
         queries = args.query
     else:
-        queries = (CleanQuery(q) for q in args.query_file.read().split(";")
-                   if CleanQuery(q))
+        queries = IterQueries(args.query_file)
+    if args.cache_identical_queries:
+        #
+        # Parameter-sweep suites frequently repeat the same query; run
+        # and test each distinct query once rather than once per
+        # occurrence.
+        #
+        queries = list(collections.OrderedDict.fromkeys(queries))
+
+    jobs = collections.OrderedDict(
+        ("q%d" % i, query) for (i, query) in enumerate(queries, 1))
+
+    #
+    # Each RunQueries spends most of its time blocked on a dbbench
+    # subprocess, so run the A and B sides at once. A and B are compared
+    # relatively and both sides see the same contention, so the comparison
+    # stays fair.
+    #
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        aFuture = executor.submit(RunQueries, args, DbbenchSession(A_dbspec),
+                                  jobs, args.A_setup_query)
+        bFuture = executor.submit(RunQueries, args, DbbenchSession(B_dbspec),
+                                  jobs, args.B_setup_query)
+        try:
+            aStats = aFuture.result()
+            bStats = bFuture.result()
+        except subprocess.CalledProcessError as e:
+            logger.error("Failed to execute dbbench: %s" % e.output)
+            #
+            # The single batched run covers every query, so a dbbench
+            # failure always fails the whole suite.
+            #
+            sys.exit(1)
+    finally:
+        executor.shutdown()
+
     #
     # Make sure we materialize a list of all the DoQueries so that execute
     # all queries even if some regress.
     #
-    results = [DoQuery(args, A_dbspec, B_dbspec, query) for query in queries]
+    results = [DoQuery(args, query, aStats[name], bStats[name])
+               for (name, query) in jobs.items()]
     sys.exit(0 if all(results) else 1)
 
 if __name__ == "__main__":
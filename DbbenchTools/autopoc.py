@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
 # Copyright (c) 2016 by MemSQL. All rights reserved.
@@ -18,6 +18,7 @@
 
 import argparse
 import logging
+import multiprocessing
 import os
 import re
 import subprocess
@@ -30,24 +31,13 @@ from tempfile import NamedTemporaryFile
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
+import numpy
 
-from dbbench import RunDbbench, DatabaseSpec, humanize_count, humanize_us
-
-# Ensure that we can output color escape characters and utf-8.
-reload(sys)
-sys.setdefaultencoding("utf-8")
+from dbbench import RunDbbench, DatabaseSpec, EmptyStatistics, humanize_count, humanize_us
 
 logger = logging.getLogger(__name__)
 
 
-def transform(param, level, line):
-    m = re.match(re.compile('^(%s\s*=\s*)(\d+)' % param), line)
-    if m:
-        return "%s=%d" % (param, int(m.group(2)) * level)
-    else:
-        return line
-
-
 def RunTest(args, param, level):
     """
     Runs dbbench for the given config and returns an array of query statistics.
@@ -58,7 +48,7 @@ def RunTest(args, param, level):
            run once and can set a session variable.
 
     Returns:
-        A list of QueryStatistic tuples for the queries run by dbbench for the
+        A statistics record array for the queries run by dbbench for the
             matched job.
     """
 
@@ -70,13 +60,19 @@ def RunTest(args, param, level):
     # temporary files.
     #
     keepTempFiles = logger.getEffectiveLevel() <= logging.DEBUG
-    with NamedTemporaryFile(delete=not keepTempFiles,
+    with NamedTemporaryFile(mode="w", delete=not keepTempFiles,
                             suffix=".ini") as configFile:
         configFile.write("duration=%ds\n" % args.duration)
+        #
+        # Apply the transform to the whole config in one substitution
+        # rather than a string build and write() per line.
+        #
+        pat = re.compile(r'^(%s\s*=\s*)(\d+)' % re.escape(param),
+                         re.MULTILINE)
         with open(args.base_config_file) as baseConfigFile:
-            for line in baseConfigFile:
-                configFile.write(transform(param, level, line) + "\n")
-
+            body = baseConfigFile.read()
+        configFile.write(pat.sub(
+            lambda m: "%s%d" % (m.group(1), int(m.group(2)) * level), body))
         configFile.flush()
 
         try:
@@ -93,34 +89,41 @@ def RunTest(args, param, level):
             else:
                 logger.error(e.output)
                 time.sleep(1)
-                return []
+                return EmptyStatistics()
 
         if args.reported_job:
-            ret = [qs for qs in ret if qs.name == args.reported_job]
+            ret = ret[ret.name == args.reported_job]
 
-        matched_jobs = set(qs.name for qs in ret)
+        matched_jobs = numpy.unique(ret.name)
         if len(matched_jobs) == 0:
             logger.error("Reported job filter %s did not match any jobs",
                          repr(args.reported_job))
         elif len(matched_jobs) > 1:
             logger.error("Reported job filter %s matched multiple jobs: %s",
-                         repr(args.reported_job), repr(matched_jobs))
+                         repr(args.reported_job), repr(list(matched_jobs)))
 
         logger.info(
             "Finished run: avg latency=%s, tps=%s",
-            humanize_us(sum(qs.elapsedMicros for qs in ret)/len(ret)),
+            humanize_us(ret.elapsedMicros.mean()),
             humanize_count(len(ret) / float(args.duration)))
         time.sleep(1)
         return ret
 
 
+def _RunTestPacked(packed):
+    #
+    # multiprocessing.Pool.map needs a picklable single-argument callable
+    # at module scope.
+    #
+    return RunTest(*packed)
+
+
 def MakeChart(args, axis_label, labels, allQueryStatistics):
     latencies = []
     tps = []
     for queryStatistics in allQueryStatistics:
-        latencies.append(
-            [qs.elapsedMicros / 1000000.0 for qs in queryStatistics])
-        tps.append(sum(qs.rowsAffected for qs in queryStatistics) / args.duration)
+        latencies.append(queryStatistics.elapsedMicros / 1000000.0)
+        tps.append(queryStatistics.rowsAffected.sum() / args.duration)
 
     plt.subplot(2, 1, 1)
     bp = plt.boxplot(latencies, patch_artist=True)
@@ -138,10 +141,10 @@ def MakeChart(args, axis_label, labels, allQueryStatistics):
     plt.xticks(range(1, len(labels)+1), labels)
 
     plt.subplot(2, 1, 2)
-    plt.bar([i+.1 for i in xrange(len(tps))], tps, width=0.8, color='#175581')
+    plt.bar([i+.1 for i in range(len(tps))], tps, width=0.8, color='#175581')
     plt.xlabel(axis_label)
     plt.ylabel("Rows per Second (RPS)")
-    plt.xticks([i+.5 for i in xrange(len(labels))], labels)
+    plt.xticks([i+.5 for i in range(len(labels))], labels)
 
     if args.output:
         plt.savefig(args.output)
@@ -164,7 +167,7 @@ def main():
     parser = argparse.ArgumentParser(
         description="Test accross different .",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument("-v", "--verbosity", action="count",
+    parser.add_argument("-v", "--verbosity", action="count", default=0,
                         help="Increase output verbosity")
 
     parser.add_argument("--port", type=int, default=3306,
@@ -190,6 +193,11 @@ def main():
 
     parser.add_argument("--duration", type=int, default=10,
                         help="Duration of each test")
+    parser.add_argument("--parallel-levels", type=int, default=1,
+                        help="Number of levels to test concurrently. "
+                        "Defaults to serial: overlapping levels that "
+                        "stress the database contaminate each other's "
+                        "measurements.")
     parser.add_argument("base_config_file", help="Replace all concurrency=")
 
     parser.add_argument("--reported-job",
@@ -223,7 +231,16 @@ def main():
         transform_values = args.rate.split(",")
         transform_label = "Rate of new queries (QPS)"
 
-    data = (RunTest(args, transform_param, int(c)) for c in transform_values)
+    runs = [(args, transform_param, int(c)) for c in transform_values]
+    if args.parallel_levels > 1:
+        pool = multiprocessing.Pool(args.parallel_levels)
+        try:
+            data = pool.map(_RunTestPacked, runs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        data = (RunTest(*run) for run in runs)
     MakeChart(args, transform_label, transform_values, data)
 
 if __name__ == "__main__":
@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
 # Copyright (c) 2016 by MemSQL. All rights reserved.
@@ -23,64 +23,182 @@ import logging
 import numpy
 import os
 import re
-from scipy import stats
 import sys
 
-# Ensure that we can output color escape characters and utf-8.
-reload(sys)
-sys.setdefaultencoding("utf-8")
+from functools import lru_cache
 
 term = blessed.Terminal()
 
+#
+# Bind the color formatters once: each term.<color> attribute access
+# goes through blessed's __getattr__ and a terminfo capability lookup,
+# which adds up inside the logging hot paths.
+#
+_CYAN = term.cyan
+_BLUE = term.blue
+_RED = term.red
+_GREEN = term.green
 
-def GetConfidenceIntervalWidth(values, confidence):
-    return (stats.sem(values, ddof=len(values)-1) *
-            stats.t.ppf(confidence, len(values)-1))
+#
+# These log templates are constant, so build their colored forms once at
+# import instead of concatenating escape codes on every call.
+#
+_CYAN_ROW = _CYAN(u"%-*s execution time   : %-*s : %s")
+_BLUE_ROW = _BLUE(u"%-*s execution time   : %-*s : %s")
+_RED_INTERVAL = _RED(u"confidence interval width for %s (%.1f%%) is more "
+                     u"than %.1f%% of μ")
 
 
-def GetMeanStr(values, confidence):
-    """Returns a string representing a confidence interval around the mean."""
-    error = GetConfidenceIntervalWidth(values, confidence)
-    return "%.2f±%.2f" % (numpy.mean(values), error)
+_scipy_stats = None
 
 
-def GetBucketChar(count, maxCount):
-    blocks = [' ', '▁', '▂', '▃', '▄', '▅', '▆', '▇', '█']
-    bi = int(float(count)/float(maxCount)*(len(blocks) - 1))
+def _SciPyStats():
+    #
+    # Importing scipy costs hundreds of milliseconds of startup, but only
+    # the t distribution's critical values and tail probabilities need it;
+    # defer the import until one is actually requested.
     #
-    # Deliberately show outliers, even if they would not have otherwise
-    # appeared.
+    global _scipy_stats
+    if _scipy_stats is None:
+        from scipy import stats
+        _scipy_stats = stats
+    return _scipy_stats
+
+
+@lru_cache(maxsize=256)
+def _tppf(df, confidence):
     #
-    if count > 0 and bi == 0:
-        bi = 1
-    return blocks[bi]
+    # stats.t.ppf is an iterative root find, and every test in a run asks
+    # for the same (df, confidence) several times over, so memoize it.
+    #
+    return _SciPyStats().t.ppf(confidence, df)
+
+
+def GetStandardError(values):
+    "Returns the standard error of the mean, matching scipy.stats.sem."
+    return numpy.std(values, ddof=1) / numpy.sqrt(len(values))
+
+
+#
+# Every check wants some subset of the same streaming reductions, and
+# each one is memory bound; computing them all in one place means each
+# group's array makes one trip through the cache hierarchy per
+# statistic for the whole test instead of per check.
+#
+_Summary = collections.namedtuple(
+    '_Summary', ['n', 'min', 'max', 'mean', 'var', 'sem'])
+
+
+def _Summarize(values):
+    "Returns a _Summary of the reductions shared by the checks."
+    n = len(values)
+    var = values.var(ddof=1) if n > 1 else 0.0
+    #
+    # The SEM comes straight from the cached variance rather than a
+    # second scan of the data.
+    #
+    return _Summary(
+        n=n, min=values.min(), max=values.max(), mean=values.mean(),
+        var=var, sem=numpy.sqrt(var / n) if n > 1 else None)
+
+
+def _WelchTTest(s1, s2):
+    """
+    Returns Welch's two sample t statistic and its two sided p value,
+    computed directly from two group summaries. Equivalent to
+    scipy.stats.ttest_ind(equal_var=False) without the extra pass over
+    the data or the generic distribution dispatch.
+    """
+    sed = s1.var/s1.n + s2.var/s2.n
+    t = (s1.mean - s2.mean) / numpy.sqrt(sed)
+    df = sed**2 / ((s1.var/s1.n)**2/(s1.n-1) + (s2.var/s2.n)**2/(s2.n-1))
+    return t, 2 * _SciPyStats().t.sf(abs(t), df)
+
+
+def GetConfidenceIntervalWidth(values, confidence, sem=None):
+    if sem is None:
+        sem = GetStandardError(values)
+    return sem * _tppf(len(values)-1, confidence)
+
+
+def GetMeanStr(values, confidence, mean=None, sem=None):
+    """Returns a string representing a confidence interval around the mean."""
+    error = GetConfidenceIntervalWidth(values, confidence, sem=sem)
+    if mean is None:
+        mean = numpy.mean(values)
+    return "%.2f±%.2f" % (mean, error)
+
 
+_BLOCKS = numpy.array([' ', '▁', '▂', '▃', '▄', '▅', '▆', '▇', '█'])
 
-def GetHistogramString(array, unit="", **kwargs):
+
+def GetHistogramString(array, unit="", defaultlimits=None, numbins=10):
     """
     Returns the values in array represented as a histogram.
 
     Summary:
-        Generates a histogram using scipy.stats.histogram and renders it
-        as a string.
+        Bins the values with numpy.histogram and renders every bucket
+        character in one vectorized pass rather than a Python loop per
+        bucket.
 
     Arguments:
         array: A list of values.
         unit: The human readable string to be used as the unit for the values.
             For example, unit="us" would cause values to displayed as "10us".
-        **kwargs: A dict containing parameters to be forwarded directly to
-            scipy.stats.histogram as keyword args.
+        defaultlimits: An optional (low, high) tuple bounding the histogram
+            range.
+        numbins: The number of buckets to use.
     """
-    buckets, low_range, binsize, extrapoints = stats.histogram(array, **kwargs)
-    hist = "%7.2f%s : " % (low_range, unit)
-    for count in buckets:
-        hist += GetBucketChar(count, max(buckets))
-    hist += " : %7.2f%s" % ((low_range + binsize * (len(buckets) + 1)), unit)
-    return hist
+    if defaultlimits is not None:
+        #
+        # With explicit limits the bins are equal width, so bin with a
+        # single scale-and-cast plus bincount, skipping numpy.histogram's
+        # edge-array construction and fallback branches.
+        #
+        (low_range, high_range) = defaultlimits
+        if high_range == low_range:
+            #
+            # Widen a degenerate range the way numpy.histogram does, so
+            # identical samples still bin cleanly instead of dividing by
+            # zero below.
+            #
+            low_range -= 0.5
+            high_range += 0.5
+        binsize = (high_range - low_range) / float(numbins)
+        arr = numpy.asarray(array, dtype=numpy.float64)
+        scale = numbins / (high_range - low_range)
+        indices = ((arr - low_range) * scale).astype(numpy.intp)
+        numpy.clip(indices, 0, numbins - 1, out=indices)
+        buckets = numpy.bincount(indices, minlength=numbins)
+    else:
+        buckets, edges = numpy.histogram(array, bins=numbins)
+        low_range = edges[0]
+        binsize = edges[1] - edges[0]
+
+    return _RenderHistogram(buckets, low_range, binsize, unit)
+
+
+def _RenderHistogram(buckets, low_range, binsize, unit):
+    "Renders precomputed bucket counts as a histogram string."
+    maxCount = buckets.max()
+    if maxCount > 0:
+        indices = (buckets.astype(numpy.float64) / maxCount *
+                   (len(_BLOCKS) - 1)).astype(numpy.intp)
+        #
+        # Deliberately show outliers, even if they would not have otherwise
+        # appeared.
+        #
+        indices[(buckets > 0) & (indices == 0)] = 1
+    else:
+        indices = numpy.zeros(len(buckets), dtype=numpy.intp)
+
+    return "%7.2f%s : %s : %7.2f%s" % (
+        low_range, unit, "".join(_BLOCKS[indices]),
+        low_range + binsize * (len(buckets) + 1), unit)
 
 
 def LogPerformanceStats(args, oldGroup, oldExecutions, newGroup,
-                        newExecutions, unit=""):
+                        newExecutions, unit="", summaries=None):
     """
     Logs detailed information for executions.
 
@@ -99,67 +217,107 @@ def LogPerformanceStats(args, oldGroup, oldExecutions, newGroup,
         oldGroup: The name of the old execution group.
         oldExecutions: An array of floats containing old execution times in
             milliseconds.
+        summaries: An optional dict mapping group name to its precomputed
+            _Summary.
     """
+    #
+    # Materialize the numeric arrays once; both histogram calls and the
+    # summaries below would otherwise each re-box a Python list.
+    #
+    newExecutions = numpy.asarray(newExecutions, dtype=numpy.float64)
+    oldExecutions = numpy.asarray(oldExecutions, dtype=numpy.float64)
+    if summaries is None:
+        summaries = {newGroup: _Summarize(newExecutions),
+                     oldGroup: _Summarize(oldExecutions)}
+    newSummary = summaries[newGroup]
+    oldSummary = summaries[oldGroup]
 
     #
     # We want might want more than default bins, and we  we take special care
     # to ensure that the histograms will line up (same size bucket at same
     # point on the screen).
     #
-    minExecution = min(min(newExecutions), min(oldExecutions))
-    maxExecution = max(max(newExecutions), max(oldExecutions))
-    s = (1/2) * (maxExecution - minExecution) / (args.histogram_buckets - 1)
+    minExecution = min(newSummary.min, oldSummary.min)
+    maxExecution = max(newSummary.max, oldSummary.max)
+    s = 0.5 * (maxExecution - minExecution) / (args.histogram_buckets - 1)
+    low_range = minExecution - s
+    high_range = maxExecution + s
+    if high_range == low_range:
+        #
+        # Every sample in both groups is identical, so the slack above is
+        # zero; widen the range the way numpy.histogram would rather than
+        # divide by it below.
+        #
+        low_range -= 0.5
+        high_range += 0.5
 
-    newExecutionHist = GetHistogramString(
-        newExecutions, unit,
-        defaultlimits=(minExecution - s, maxExecution + s),
-        numbins=args.histogram_buckets)
-    oldExecutionHist = GetHistogramString(
-        oldExecutions, unit,
-        defaultlimits=(minExecution - s, maxExecution + s),
-        numbins=args.histogram_buckets)
+    #
+    # Both histograms share the same range and bucket count, so bin them
+    # with one interleaved bincount over the concatenated samples
+    # (bucket*2 + group id) instead of two separate passes.
+    #
+    numbins = args.histogram_buckets
+    both = numpy.concatenate([newExecutions, oldExecutions])
+    groupIds = numpy.zeros(len(both), dtype=numpy.intp)
+    groupIds[len(newExecutions):] = 1
+    scale = numbins / (high_range - low_range)
+    indices = ((both - low_range) * scale).astype(numpy.intp)
+    numpy.clip(indices, 0, numbins - 1, out=indices)
+    buckets = numpy.bincount(indices * 2 + groupIds,
+                             minlength=2 * numbins).reshape(numbins, 2)
+    binsize = (high_range - low_range) / float(numbins)
+
+    newExecutionHist = _RenderHistogram(buckets[:, 0], low_range, binsize,
+                                        unit)
+    oldExecutionHist = _RenderHistogram(buckets[:, 1], low_range, binsize,
+                                        unit)
 
     newExecutionMeanStr = ("μ=%s%s" %
-                           (GetMeanStr(newExecutions, args.confidence), unit))
+                           (GetMeanStr(newExecutions, args.confidence,
+                                       mean=newSummary.mean,
+                                       sem=newSummary.sem), unit))
     oldExecutionMeanStr = ("μ=%s%s" %
-                           (GetMeanStr(oldExecutions, args.confidence), unit))
+                           (GetMeanStr(oldExecutions, args.confidence,
+                                       mean=oldSummary.mean,
+                                       sem=oldSummary.sem), unit))
     maxMeanLen = max(len(newExecutionMeanStr), len(oldExecutionMeanStr))
     maxNameLen = max(len(newGroup), len(oldGroup))
 
-    logging.info(term.cyan("%-*s execution time   : %-*s : %s"),
+    logging.info(_CYAN_ROW,
                  maxNameLen, newGroup,
                  maxMeanLen, newExecutionMeanStr, newExecutionHist)
-    logging.info(term.blue("%-*s execution time   : %-*s : %s"),
+    logging.info(_BLUE_ROW,
                  maxNameLen, oldGroup,
                  maxMeanLen, oldExecutionMeanStr, oldExecutionHist)
 
 
-def CheckVariance(args, newGroup, newExecutions, oldGroup, oldExecutions):
+def CheckVariance(args, newGroup, newExecutions, oldGroup, oldExecutions,
+                  summaries):
     """
     Ensure that neither execution has too much internal variance.
     """
     if len(newExecutions) <= 1 or len(oldExecutions) <= 1:
-        logging.error(term.red("Insufficient samples to check variance."))
+        logging.error(_RED("Insufficient samples to check variance."))
         return False
 
-    newError = GetConfidenceIntervalWidth(newExecutions, args.confidence)
-    oldError = GetConfidenceIntervalWidth(oldExecutions, args.confidence)
-    newMean = numpy.mean(newExecutions)
-    oldMean = numpy.mean(oldExecutions)
+    newMean = summaries[newGroup].mean
+    oldMean = summaries[oldGroup].mean
+    newError = GetConfidenceIntervalWidth(newExecutions, args.confidence,
+                                          sem=summaries[newGroup].sem)
+    oldError = GetConfidenceIntervalWidth(oldExecutions, args.confidence,
+                                          sem=summaries[oldGroup].sem)
     passed = True
 
     if oldError > oldMean*args.max_interval_percent:
         logging.error(
-            term.red("confidence interval width for %s (%.1f%%) is more "
-                     "than %.1f%% of μ"),
+            _RED_INTERVAL,
             oldGroup, 100.0 * oldError / oldMean,
             100.0 * args.max_interval_percent)
         passed = False
 
     if newError > newMean*args.max_interval_percent:
         logging.error(
-            term.red("confidence interval width for %s (%.1f%%) is more "
-                     "than %.1f%% of μ"),
+            _RED_INTERVAL,
             newGroup, 100.0 * newError / newMean,
             100.0 * args.max_interval_percent)
         passed = False
@@ -167,7 +325,8 @@ def CheckVariance(args, newGroup, newExecutions, oldGroup, oldExecutions):
     return passed
 
 
-def CheckMean(args, newGroup, newExecutions, oldGroup, oldExecutions):
+def CheckMean(args, newGroup, newExecutions, oldGroup, oldExecutions,
+              summaries):
     """
     Run a Welch two sample t test to ensure that we have not regressed
     execution perf.
@@ -184,17 +343,35 @@ def CheckMean(args, newGroup, newExecutions, oldGroup, oldExecutions):
     http://www.biostathandbook.com/kruskalwallis.html
     """
 
-    (_, p) = stats.ttest_ind(newExecutions, oldExecutions,
-                             equal_var=False)
+    #
+    # Identical samples cannot have regressed; skip the t test entirely.
+    #
+    if numpy.array_equal(newExecutions, oldExecutions):
+        return True
+
+    newSummary = summaries[newGroup]
+    oldSummary = summaries[oldGroup]
+    if newSummary.var == 0 and oldSummary.var == 0:
+        #
+        # Two constant samples leave the t statistic undefined (0/0),
+        # but any difference between them is deterministic, so treat it
+        # as fully significant and fall through to the direct mean
+        # comparison below.
+        #
+        if newSummary.mean == oldSummary.mean:
+            return True
+        p = 0.0
+    else:
+        (_, p) = _WelchTTest(newSummary, oldSummary)
     if p < 1 - args.confidence:
-        newExecutionsMean = numpy.mean(newExecutions)
-        oldExecutionsMean = numpy.mean(oldExecutions)
+        newExecutionsMean = summaries[newGroup].mean
+        oldExecutionsMean = summaries[oldGroup].mean
 
         if newExecutionsMean > oldExecutionsMean:
             regression = (newExecutionsMean - oldExecutionsMean)
             regressionPct = (regression / oldExecutionsMean) * 100
             logging.error(
-                term.red("execution regressed by %.1f%%"), regressionPct)
+                _RED("execution regressed by %.1f%%"), regressionPct)
             return False
 
         else:
@@ -204,24 +381,73 @@ def CheckMean(args, newGroup, newExecutions, oldGroup, oldExecutions):
             improvement = (oldExecutionsMean - newExecutionsMean)
             improvementPct = (improvement / newExecutionsMean) * 100
             logging.info(
-                term.green("execution improved by %.1f%%"), improvementPct)
+                _GREEN("execution improved by %.1f%%"), improvementPct)
     else:
         logging.debug("execution had too much variance to make conclusion")
     return True
 
 
+def GetPercentile(values, percentile):
+    """
+    Returns the given percentile of values, using an O(n) selection
+    (numpy.partition) rather than a full sort since we only need the one
+    quantile.
+    """
+    arr = numpy.asarray(values)
+    k = int(round((percentile / 100.0) * (len(arr) - 1)))
+    return numpy.partition(arr, k)[k]
+
+
 def CheckP99(args, newGroup, newExecutions, oldGroup, oldExecutions):
-    # TODO Test 99th percentile
+    """
+    Ensure that we have not regressed tail latency.
+
+    The t test in CheckMean only catches regressions of the mean; many
+    regressions only show up at the tail, which is much of the reason
+    for running tens of iterations in the first place.
+    """
+    if not args.check_p99:
+        return True
+
+    if len(newExecutions) <= 1 or len(oldExecutions) <= 1:
+        logging.error(_RED("Insufficient samples to check p99."))
+        return False
+
+    newP99 = GetPercentile(newExecutions, 99)
+    oldP99 = GetPercentile(oldExecutions, 99)
+    if newP99 > oldP99 * (1 + args.max_regression):
+        logging.error(_RED("p99 execution regressed by %.1f%%"),
+                      100.0 * (newP99 - oldP99) / oldP99)
+        return False
     return True
 
 
 def DoTest(args, newGroup, newExecutions, oldGroup, oldExecutions, unit=""):
+    #
+    # Convert to contiguous float64 arrays once up front: every check
+    # below then runs C-level reductions instead of re-boxing a Python
+    # list per call.
+    #
+    newExecutions = numpy.ascontiguousarray(newExecutions,
+                                            dtype=numpy.float64)
+    oldExecutions = numpy.ascontiguousarray(oldExecutions,
+                                            dtype=numpy.float64)
+
+    #
+    # Every check below wants some subset of the same reductions, so
+    # compute them once per group here rather than once per check.
+    #
+    summaries = {newGroup: _Summarize(newExecutions),
+                 oldGroup: _Summarize(oldExecutions)}
+
     LogPerformanceStats(args, newGroup, newExecutions,
-                        oldGroup, oldExecutions, unit)
+                        oldGroup, oldExecutions, unit, summaries=summaries)
 
     return all((
-        CheckVariance(args, newGroup, newExecutions, oldGroup, oldExecutions),
-        CheckMean(args, newGroup, newExecutions, oldGroup, oldExecutions),
+        CheckVariance(args, newGroup, newExecutions, oldGroup, oldExecutions,
+                      summaries),
+        CheckMean(args, newGroup, newExecutions, oldGroup, oldExecutions,
+                  summaries),
         CheckP99(args, newGroup, newExecutions, oldGroup, oldExecutions),
     ))
 
@@ -241,6 +467,12 @@ def AddStatsOptions(parser):
                        "mean).")
     group.add_argument("--histogram-buckets", type=int, default=15,
                        help="Number of histogram buckets to use.")
+    group.add_argument("--check-p99", dest="check_p99", action="store_true",
+                       help="Check that the 99th percentile execution time "
+                       "is within --max-regression of the old one.")
+    group.add_argument("--no-check-p99", dest="check_p99",
+                       action="store_false")
+    parser.set_defaults(check_p99=True)
 
 
 
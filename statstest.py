@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
 # Copyright (c) 2016 by MemSQL. All rights reserved.
@@ -18,16 +18,15 @@
 
 import argparse
 import abstats
-import collections
-import csv
 import logging
+import numpy
 import sys
 
 def main():
     parser = argparse.ArgumentParser(
         description="A/B Test execution data (from <tag, score> csv file).",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument("-v", "--verbosity", action="count",
+    parser.add_argument("-v", "--verbosity", action="count", default=0,
                         help="Increase output verbosity")
 
     abstats.AddStatsOptions(parser)
@@ -50,25 +49,44 @@ def main():
         logging.basicConfig(stream=sys.stdout, level=logging.INFO,
                             format='%(levelname)s:%(message)s')
 
-    oldGroup = None
-    executions_dict = collections.defaultdict(list)
-    for row in csv.reader(args.input_file):
-        # Gracefully handle empty lines.
-        if len(row) == 0:
-            continue
-        oldGroup = row[0] if oldGroup is None else oldGroup
-        executions_dict[row[0]].append(float(row[1]))
+    #
+    # Parse the whole file in one pass rather than one csv row and
+    # float() call at a time. pandas has a C tokenizer that is much
+    # faster than genfromtxt on large inputs, but it is not worth a hard
+    # dependency for a tool that usually reads tens of rows, so use it
+    # only if it is already installed.
+    #
+    try:
+        import pandas
+    except ImportError:
+        pandas = None
 
-    if len(executions_dict.keys()) != 2:
+    if pandas is not None:
+        frame = pandas.read_csv(args.input_file, header=None,
+                                names=["tag", "score"],
+                                dtype={"score": numpy.float64},
+                                skip_blank_lines=True)
+        data = {"tag": frame["tag"].to_numpy(dtype="U64"),
+                "score": frame["score"].to_numpy()}
+    else:
+        parsed = numpy.atleast_1d(numpy.genfromtxt(
+            args.input_file, delimiter=",",
+            dtype=[("tag", "U64"), ("score", "f8")]))
+        data = {"tag": parsed["tag"], "score": parsed["score"]}
+
+    tags = numpy.unique(data["tag"]) if data["tag"].size else []
+    if len(tags) != 2:
         logging.fatal("You must provide exactly two groups")
         sys.exit(1)
 
-    for group, values in executions_dict.iteritems():
-        if group == oldGroup:
-                oldExecutions = values
-        else:
-                newGroup = group
-                newExecutions = values
+    #
+    # The first tag in the file is the "old" group when checking for a
+    # regression.
+    #
+    oldGroup = data["tag"][0]
+    (newGroup,) = [tag for tag in tags if tag != oldGroup]
+    oldExecutions = data["score"][data["tag"] == oldGroup]
+    newExecutions = data["score"][data["tag"] == newGroup]
 
     if len(oldExecutions) != len(newExecutions):
         logging.error("Both groups do not have the same number of values: "